@@ -2,91 +2,232 @@ import logging
 import os
 import platform
 import time
+from functools import lru_cache
 
 import schedule
 import yagmail
 from dotenv import load_dotenv
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from otomoto_scrapper import OtomotoScrapper
 from pepper_scrapper import PepperScrapper
 
+# Credentials and search urls do not change while the scheduler runs, read .env only once
+load_dotenv()
+
 """ abc
 LZX_RSS_URL = secrets['lzx_rss_url']
 
-def parse_date(datetime_str: str) -> str:
-    datetime_obj = parse(datetime_str)
-    return format_date(datetime_obj, format='medium', locale='pl_PL')
+@lru_cache(maxsize=4096)
+def format_published_date(published: date) -> str:
+    # Most entries of daily feed share the same day, format each day only once
+    return format_date(published, format='medium', locale='pl_PL')
+
+
+FEED_STATE_PATH = Path('feed_state.json')
+
+
+def load_feed_state() -> dict[str, dict[str, str]]:
+    if FEED_STATE_PATH.exists():
+        with open(FEED_STATE_PATH, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_feed_state(state: dict[str, dict[str, str]]) -> None:
+    with open(FEED_STATE_PATH, 'wt', encoding='utf-8') as f:
+        json.dump(state, f)
 
 
 def get_last_day_entries(rss_url: str) -> list[FeedParserDict]:
     warsaw = timezone('Europe/Warsaw')
     time_24h_ago = warsaw.localize(datetime.now() - timedelta(hours=24, minutes=10))
 
-    feed = feedparser.parse(rss_url, modified=time_24h_ago.strftime('%a, %d %b %Y %H:%M:%S %Z'))
-    return [entry for entry in feed.entries if parse(entry.published) > time_24h_ago]
+    state = load_feed_state()
+    feed_state = state.get(rss_url, {})
+    headers = {'If-Modified-Since': feed_state.get('modified', time_24h_ago.strftime('%a, %d %b %Y %H:%M:%S %Z'))}
+    if etag := feed_state.get('etag'):
+        headers['If-None-Match'] = etag
+    # Download through the shared pooled session and hand raw bytes to feedparser
+    response = HTTP_SESSION.get(rss_url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        logging.debug(f'Feed not modified: {rss_url}')
+        return []
+    response.raise_for_status()
+    feed = feedparser.parse(response.content, response_headers=response.headers)
+    state[rss_url] = {
+        k: response.headers[h] for k, h in (('etag', 'ETag'), ('modified', 'Last-Modified')) if h in response.headers
+    }
+    save_feed_state(state)
+    for entry in feed.entries:
+        # dateutil parsing is slow, keep parsed value for later formatting
+        entry.published_dt = parse(entry.published)
+    return [entry for entry in feed.entries if entry.published_dt > time_24h_ago]
+
+
+HTTP_WORKERS = 32
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_maxsize=HTTP_WORKERS))
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_maxsize=HTTP_WORKERS))
+
+
+IMAGE_HASH_CACHE_PATH = Path('image_phash_cache.pkl.zstd')
+IMAGE_HASH_CACHE_TTL = timedelta(days=30)
+MAX_IMAGE_SIZE = 256 * 1024
+# 16x16 phash runs DCT on 64x64 image, anything above that is wasted decoding
+THUMBNAIL_SIZE = (64, 64)
+NO_PHOTO_SUFFIXES = ('nophoto.png', 'no_photo.png')
+# Placeholder image URL is usually the same for all offers without photo
+NO_PHOTO_URLS: set[str] = set()
+
+
+def load_image_hash_cache() -> dict[str, tuple[bytes, datetime]]:
+    if IMAGE_HASH_CACHE_PATH.exists():
+        with open(IMAGE_HASH_CACHE_PATH, 'rb') as f:
+            data = f.read()
+        return pickle.loads(ZstdDecompressor().decompress(data))
+    return {}
+
+
+def save_image_hash_cache(
+        entries: list[FeedParserDict], image_hashes: list[bytes | None], cache: dict[str, tuple[bytes, datetime]]
+) -> None:
+    now = datetime.now()
+    cache.update({entry.href: (h, now) for entry, h in zip(entries, image_hashes) if h is not None})
+    # Drop images that were not seen in feed for a while, so cache does not grow forever
+    expired = [href for href, (_, last_seen) in cache.items() if now - last_seen > IMAGE_HASH_CACHE_TTL]
+    for href in expired:
+        del cache[href]
+    data = pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(IMAGE_HASH_CACHE_PATH, 'wb') as f:
+        f.write(ZstdCompressor().compress(data))
 
 
 def get_direct_link(item: FeedParserDict) -> FeedParserDict:
     url = item.link
-    response = requests.head(url, allow_redirects=True)  # , verify=False)
+    response = HTTP_SESSION.head(url, allow_redirects=True, timeout=10)  # , verify=False)
     item['link'] = response.url
     return item
 
 
-def assign_direct_offers_links(entries: list[FeedParserDict]) -> list[FeedParserDict]:
-    with ThreadPoolExecutor() as executor:
-        return list(executor.map(get_direct_link, entries))
+try:
+    from turbojpeg import TJPF_GRAY, TurboJPEG
+    TURBO_JPEG = TurboJPEG()
+except (ImportError, RuntimeError):
+    # PyTurboJPEG or libjpeg-turbo not available, Pillow is used for every image
+    TURBO_JPEG = None
+
+
+def decode_thumbnail(data: bytes) -> Image.Image:
+    if TURBO_JPEG is not None and data.startswith(b'\xff\xd8'):
+        # libjpeg-turbo SIMD decode straight to grayscale at 1/8 scale
+        return Image.fromarray(TURBO_JPEG.decode(data, pixel_format=TJPF_GRAY, scaling_factor=(1, 8))[:, :, 0], 'L')
+    image = Image.open(BytesIO(data))
+    # Hashing needs only a tiny grayscale image, let JPEG decoder downscale while decoding
+    image.draft('L', THUMBNAIL_SIZE)
+    image.load()
+    image.thumbnail(THUMBNAIL_SIZE, Image.Resampling.BILINEAR)
+    return image
+
+
+def get_image_hash_lzx(href: str, hash_cache: dict[str, tuple[bytes, datetime]]) -> bytes | None:
+    if href in NO_PHOTO_URLS or href.lower().endswith(NO_PHOTO_SUFFIXES):
+        NO_PHOTO_URLS.add(href)
+        return None
+    if cached := hash_cache.get(href):
+        # Hash is known from previous runs, no need to download and decode the image again
+        return cached[0]
+    try:
+        with HTTP_SESSION.get(href, headers={'User-Agent': 'Mozilla/5.0'}, stream=True, timeout=10) as r:
+            r.raise_for_status()
+            data = r.raw.read(MAX_IMAGE_SIZE + 1, decode_content=True)
+    except requests.RequestException:
+        logging.warning(f'Failed to download image: {href}')
+        return None
+    if len(data) > MAX_IMAGE_SIZE:
+        logging.warning(f'Skipping too large image: {href}')
+        return None
+    try:
+        image = decode_thumbnail(data)
+    except OSError:
+        # Covers PIL UnidentifiedImageError and truncated or broken JPEG data
+        logging.warning(f'Failed to decode image: {href}')
+        return None
+    # 16x16 perceptual hash = 256 bits, packed to 32 bytes so the PIL image can be dropped right away
+    return np.packbits(imagehash.phash(image, hash_size=16).hash.flatten()).tobytes()
+
+
+def enrich_entries_lzx(
+        entries: list[FeedParserDict], hash_cache: dict[str, tuple[bytes, datetime]]
+) -> list[bytes | None]:
+    def enrich(entry: FeedParserDict) -> bytes | None:
+        # Offer link and image are independent, resolve both in the same worker over the shared pool
+        try:
+            get_direct_link(entry)
+        except requests.RequestException:
+            # Keep original feed link, one slow redirect must not fail the whole batch
+            logging.warning(f'Failed to resolve direct link: {entry.link}')
+        return get_image_hash_lzx(entry.href, hash_cache)
 
+    # Shared keep-alive pool: one TLS handshake per host instead of one per entry
+    with ThreadPoolExecutor(max_workers=min(HTTP_WORKERS, len(entries) or 1)) as executor:
+        return list(executor.map(enrich, entries))
 
-def assign_images_lzx(entries: list[FeedParserDict]) -> list[FeedParserDict]:
-    for entry in entries:
-        try:
-            if entry.href.lower().endswith('nophoto.png'):
-                entry.image = None
-                continue
-            req = urllib.request.Request(entry.href, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req) as url:
-                entry.image = Image.open(url)
-        except HTTPError:
-            print(entry.href)
-            entry.image = None
-    return entries
+
+NON_ALPHANUMERIC_RE = re.compile(r'[^a-zA-Z0-9]+')
 
 
 def remove_special_characters(input_string: str) -> str:
-    return re.sub(r'[^a-zA-Z0-9]', '', input_string).lower()
+    return NON_ALPHANUMERIC_RE.sub('', input_string).lower()
 
 
-def group_entries(entries: list[FeedParserDict]) -> list[list[FeedParserDict]]:
-    entries_c = entries.copy()
-    grouped_offers = []
+def pack_image_hashes(image_hashes: list[bytes | None]) -> tuple[np.ndarray, np.ndarray]:
+    # 256 bit hash = 4 x uint64 per entry
+    hashes = np.zeros((len(image_hashes), 4), dtype=np.uint64)
+    has_hash = np.zeros(len(image_hashes), dtype=bool)
+    for i, image_hash in enumerate(image_hashes):
+        if image_hash is not None:
+            hashes[i] = np.frombuffer(image_hash, dtype=np.uint64)
+            has_hash[i] = True
+    return hashes, has_hash
+
+
+def group_entries(entries: list[FeedParserDict], image_hashes: list[bytes | None]) -> list[list[FeedParserDict]]:
     # is_same_price = entry.summary == entry_2.summary
     # TODO: set option
     is_same_price = True
-    while entries_c:
-        entry = entries_c.pop()
-        group = [entry]
-        h_1 = None if entry.image is None else imagehash.average_hash(entry.image, 16)
-        t1 = remove_special_characters(entry.title)
-        idx_to_remove = set()
-        for i, entry_2 in enumerate(entries_c):
-            t2 = remove_special_characters(entry_2.title)
-            is_same_title = t1 == t2
-            if entry.image is None or entry_2.image is None:
-                is_same = is_same_title and is_same_price
-                if is_same:
-                    group.append(entry_2)
-                    idx_to_remove.add(i)
-                continue
-            h_2 = imagehash.average_hash(entry_2.image, 16)
-            similarity_score = (h_1 - h_2) / h_1.hash.size
-            if similarity_score < 0.1 or (is_same_title and is_same_price):
-                group.append(entry_2)
-                idx_to_remove.add(i)
-        grouped_offers.append(group)
-        entries_c = [entries_c[i] for i, _ in enumerate(entries_c) if i not in idx_to_remove]
-    return grouped_offers
+    hashes, has_hash = pack_image_hashes(image_hashes)
+    # Union-find over duplicate edges, entries similar through a chain end up in one group
+    parent = list(range(len(entries)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        parent[find(i)] = find(j)
+
+    # Title edges in O(N): every entry is joined with the first entry having the same normalized title
+    if is_same_price:
+        first_with_title = {}
+        for i, entry in enumerate(entries):
+            union(i, first_with_title.setdefault(remove_special_characters(entry.title), i))
+
+    # Image edges only exist between entries that both have a hash
+    hashed = np.flatnonzero(has_hash)
+    packed = hashes[hashed]
+    # All pairs at once: (M, M, 4) XOR + popcount, daily feed is a few hundred entries so it fits in memory easily
+    distances = np.bitwise_count(packed[:, None, :] ^ packed[None, :, :]).sum(axis=-1)
+    rows, cols = np.nonzero(np.triu(distances < 0.1 * 256, k=1))
+    for row, col in zip(hashed[rows], hashed[cols]):
+        union(row, col)
+
+    grouped_offers = defaultdict(list)
+    for i, entry in enumerate(entries):
+        grouped_offers[find(i)].append(entry)
+    return list(grouped_offers.values())
 
 
 def lzx_entry_to_dict(entry: FeedParserDict):
@@ -94,7 +235,7 @@ def lzx_entry_to_dict(entry: FeedParserDict):
         image=entry.href,
         link=entry.link,
         price=entry.summary,
-        date=parse_date(entry.published),
+        date=format_published_date(entry.published_dt.date()),
         name=entry.title
     )
 
@@ -114,10 +255,12 @@ def get_duplicated_offers(grouped_offers: list[list[FeedParserDict]]) -> list[li
 """
 
 
+# Environment keeps compiled templates, so scheduled runs don't re-read and recompile template.html
+TEMPLATE_ENV = Environment(loader=FileSystemLoader('.', encoding='utf-8'), autoescape=select_autoescape(['html']))
+
+
 def generate_html_str(unique_offers: list[dict]) -> str:
-    with open('template.html', 'rt', encoding='utf-8') as f:
-        html_template = f.read()
-    template = Template(html_template)
+    template = TEMPLATE_ENV.get_template('template.html')
     return template.render(
         individual_offers=unique_offers
     )
@@ -129,12 +272,19 @@ def send_mail(html_content: str) -> None:
     yag.send(to=os.getenv('DST_MAIL'), subject=email_subject, contents=(html_content, 'text/html'))
 
 
+@lru_cache(maxsize=1)
+def get_otomoto_scrapper() -> OtomotoScrapper:
+    # Kept alive between scheduled runs: cache is loaded from disk and HTTP session is created only once
+    return OtomotoScrapper(os.getenv('OTOMOTO_URL'))
+
+
 def main():
     """
     lzx_entries = get_last_day_entries(LZX_RSS_URL)
-    lzx_entries = assign_direct_offers_links(lzx_entries)
-    lzx_entries = assign_images_lzx(lzx_entries)
-    grouped_entries = group_entries(lzx_entries)
+    image_hash_cache = load_image_hash_cache()
+    lzx_image_hashes = enrich_entries_lzx(lzx_entries, image_hash_cache)
+    grouped_entries = group_entries(lzx_entries, lzx_image_hashes)
+    save_image_hash_cache(lzx_entries, lzx_image_hashes, image_hash_cache)
     unique_offers = get_unique_offers(grouped_entries)
     duplicated_offers = get_duplicated_offers(grouped_entries)
 
@@ -149,21 +299,17 @@ def main():
     if platform.system() == "Linux":
         os.nice(10)
 
-    load_dotenv()
-
-    otomoto_scrapper = OtomotoScrapper(os.getenv('OTOMOTO_URL'))
-    otomoto_offers = otomoto_scrapper.get_offers()
-
-    otomoto_scrapper.link = os.getenv('OTOMOTO_2_URL')
-    otomoto_offers.extend(otomoto_scrapper.get_offers())
-
-    otomoto_scrapper.link = os.getenv('OTOMOTO_MERIVA_URL')
-    otomoto_offers.extend(otomoto_scrapper.get_offers())
+    otomoto_scrapper = get_otomoto_scrapper()
+    otomoto_offers = otomoto_scrapper.get_offers_from_links(
+        [os.getenv('OTOMOTO_URL'), os.getenv('OTOMOTO_2_URL'), os.getenv('OTOMOTO_MERIVA_URL')]
+    )
 
+    otomoto_scrapper.save_cache()
     otomoto_offers = otomoto_scrapper.new_offers_to_dict(otomoto_offers)
 
     # pepper_scrapper = PepperScrapper()
     # pepper_offers = pepper_scrapper.get_hottest_pepper_offers()
+    # pepper_scrapper.save_cache()
     # pepper_offers = []
 
     html_content = generate_html_str(otomoto_offers)
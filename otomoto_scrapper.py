@@ -1,13 +1,20 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from scrapper_base import ScrapperBase
 
 
+# Only search results are needed, rest of the page (scripts, filters, footer) is not built into the tree
+SEARCH_RESULTS_STRAINER = SoupStrainer('div', {'data-testid': 'search-results'})
+
+
 @dataclass(frozen=True, slots=True)
 class OtomotoOffer:
     title: str
@@ -20,16 +27,38 @@ class OtomotoOffer:
 
 class OtomotoScrapper(ScrapperBase):
     def __init__(self, link: str):
-        super().__init__(cache_path=Path('otomoto_cache.pkl.zstd'))
+        super().__init__(cache_path=Path('otomoto_cache.pkl.zstd'), offer_type=OtomotoOffer)
         self.link = link
+        # One keep-alive session for all searches, they are served by the same host
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # raise_on_status=False: after retries the last response is returned and status check in parse_offers logs it
+        retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def get_offers(self) -> list[OtomotoOffer]:
-        response = requests.get(self.link, headers=self.headers)
+        return self.parse_offers(self.get_page(self.link))
+
+    def get_offers_from_links(self, links: list[str]) -> list[OtomotoOffer]:
+        # Pages are downloaded concurrently, parsing stays sequential so cache deduplication keeps search order
+        with ThreadPoolExecutor(max_workers=len(links) or 1) as executor:
+            responses = list(executor.map(self.get_page, links))
+        new_offers = []
+        for response in responses:
+            new_offers.extend(self.parse_offers(response))
+        return new_offers
+
+    def get_page(self, link: str) -> requests.Response:
+        return self.session.get(link, timeout=30)
+
+    def parse_offers(self, response: requests.Response) -> list[OtomotoOffer]:
         new_offers = []
         # Check if the request was successful
         if response.status_code == 200:
             # Parse the HTML using BeautifulSoup
-            soup = BeautifulSoup(response.content, 'html.parser')
+            soup = BeautifulSoup(response.content, 'html.parser', parse_only=SEARCH_RESULTS_STRAINER)
 
             if search_results_div := soup.find('div', {'data-testid': 'search-results'}):
                 # Find all the article elements inside the div
@@ -42,32 +71,28 @@ class OtomotoScrapper(ScrapperBase):
                     link = title_tag['href']
                     title = title_tag.get_text(strip=True)
 
-                    parameters = article.find_all('dd', {'data-parameter': True})
-                    params = {}
-                    for param in parameters:
-                        parameter_type = param['data-parameter']
-                        parameter_value = param.get_text(strip=True)
-                        params[parameter_type] = parameter_value
+                    params = {
+                        param['data-parameter']: param.get_text(strip=True)
+                        for param in article.find_all('dd', {'data-parameter': True})
+                    }
 
                     image_tag = article.find('img')
                     image_url = image_tag.get('src') if image_tag else None
 
                     price = ''
-                    for div in article.find_all('div'):
-                        if price_tag := div.find('p', text=lambda text: text and 'PLN' in text):
-                            h3 = div.find('h3')
-                            if h3 is None:
-                                continue
-                            price = h3.get_text(strip=True)
-                            break
+                    # Price value is in h3 next to the currency label, look only at the label's ancestors
+                    if price_tag := article.find('p', string=lambda text: text and 'PLN' in text):
+                        for div in price_tag.find_parents('div'):
+                            if h3 := div.find('h3'):
+                                price = h3.get_text(strip=True)
+                                break
 
                     if not price:
                         logging.error('Otomoto price not found')
                     offer = OtomotoOffer(title, link, params['year'], params['mileage'], image_url, price)
-                    if offer not in self.cache:
-                        logging.info(f'Found new {offer=}')
+                    if self.is_new_offer(offer):
+                        logging.info('Found new offer=%r', offer)
                         new_offers.append(offer)
-                        self.cache.add(offer)
             else:
                 logging.warning('No Otomoto offers found')
         else:
@@ -1,11 +1,14 @@
 import logging
 import os
 import platform
+import threading
+from collections.abc import Iterator
 from dataclasses import dataclass
 from pathlib import Path
 
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
@@ -13,23 +16,53 @@ from selenium.webdriver.support.wait import WebDriverWait
 from scrapper_base import ScrapperBase
 
 
-@dataclass(frozen=True, slots=True)
+# Third party analytics/ads and web fonts are not needed for reading offers and slow down page load
+BLOCKED_URL_PATTERNS = [
+    '*google-analytics.com*',
+    '*googletagmanager.com*',
+    '*doubleclick.net*',
+    '*hotjar.com*',
+    '*facebook.net*',
+    '*.woff*', '*.ttf*',
+]
+
+# Reads all offer cards in one WebDriver call instead of three element lookups per card
+HOTTEST_OFFERS_SCRIPT = """
+return Array.from(document.querySelectorAll(arguments[0])).map(item => {
+    const link = item.querySelector('a');
+    const image = item.querySelector('img');
+    return [link?.title, link?.href, image?.src];
+});
+"""
+
+
+@dataclass(frozen=True, slots=True, eq=False)
 class PepperOffer:
     name: str
     link: str
     image: str
 
+    # Offer is identified by its link, so cache lookups hash a single string
+    def __eq__(self, other):
+        if not isinstance(other, PepperOffer):
+            return NotImplemented
+        return self.link == other.link
+
+    def __hash__(self):
+        return hash(self.link)
+
 
 class PepperScrapper(ScrapperBase):
     def __init__(self):
-        super().__init__(cache_path=Path('pepper_cache.pkl.zstd'))
+        super().__init__(cache_path=Path('pepper_cache.pkl.zstd'), offer_type=PepperOffer)
         self.skip_cookies_locator = (By.XPATH, "//button[.//span[contains(text(), 'Kontynuuj bez akceptacji')]]")
         self.hottest_offers_locator = (By.CLASS_NAME, "scrollBox-item.card-item.width--all-12")
         self.today_button_locator = (By.XPATH, "//span[text()='Dzisiaj']/ancestor::button")
-        self.hottest_offers_locator = (By.CLASS_NAME, "scrollBox-item.card-item.width--all-12")
-        self.hottest_offers_locator = (By.CLASS_NAME, "scrollBox-item.card-item.width--all-12")
         self.hottest_offers_pages_locator = (By.CSS_SELECTOR, "ol.lbox--v-2 > li > button")
         self.link = os.getenv('PEPPER_URL')
+        # Chrome cold start is the slowest part of scraping, keep one browser alive between runs
+        self.driver: webdriver.Chrome | None = None
+        self.driver_lock = threading.Lock()
 
     @staticmethod
     def get_driver() -> webdriver.Chrome:
@@ -59,9 +92,35 @@ class PepperScrapper(ScrapperBase):
             "Chrome/58.0.3029.110 Safari/2b7c7"
         )
         if browser == "chrome":
-            return webdriver.Chrome(options, Service(executable_path="/usr/bin/chromedriver"))
+            driver = webdriver.Chrome(options, Service(executable_path="/usr/bin/chromedriver"))
         else:
-            return webdriver.Chrome(options=options)
+            driver = webdriver.Chrome(options=options)
+        # URL blocking is only an optimization, scraping must work also when CDP command fails
+        try:
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URL_PATTERNS})
+        except WebDriverException:
+            logging.warning('Could not block tracking requests through CDP')
+        return driver
+
+    def get_shared_driver(self) -> webdriver.Chrome:
+        if self.driver is not None:
+            try:
+                _ = self.driver.current_url
+            except WebDriverException:
+                logging.warning('Chrome driver is not responding, starting new one')
+                self.quit_driver()
+        if self.driver is None:
+            self.driver = self.get_driver()
+        return self.driver
+
+    def quit_driver(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                logging.debug('Chrome driver already closed')
+            self.driver = None
 
     @staticmethod
     def click_element(wait: WebDriverWait, element: tuple[str, str]):
@@ -70,39 +129,55 @@ class PepperScrapper(ScrapperBase):
         logging.debug(f'Clicked {element=}')
 
     def get_hottest_pepper_offers(self) -> list[PepperOffer]:
-        driver = self.get_driver()
+        with self.driver_lock:
+            driver = self.get_shared_driver()
+            try:
+                return self.scrape_hottest_pepper_offers(driver)
+            finally:
+                # Reset state instead of closing, so next run starts with clean page without browser startup
+                try:
+                    driver.delete_all_cookies()
+                    driver.get('about:blank')
+                except WebDriverException:
+                    self.quit_driver()
+
+    def scrape_hottest_pepper_offers(self, driver: webdriver.Chrome) -> list[PepperOffer]:
+        new_offers = []
+        for rows in self.scrape_hottest_pages(driver):
+            offers = (PepperOffer(title, href, image_src) for title, href, image_src in rows if href is not None)
+            page_new_offers = [offer for offer in offers if self.is_new_offer(offer)]
+            for offer in page_new_offers:
+                logging.info('Found new offer=%r', offer)
+            new_offers.extend(page_new_offers)
+            if not page_new_offers:
+                # Everything on this page was already seen, next pages are very likely seen too - skip clicking them
+                logging.debug('No new Pepper offers on page, skipping remaining pages')
+                break
+        return new_offers
+
+    def scrape_hottest_pages(self, driver: webdriver.Chrome) -> Iterator[list[list[str | None]]]:
         driver.get(self.link)
         wait = WebDriverWait(driver, 20)
         self.click_element(wait, self.skip_cookies_locator)
 
         pagination_buttons = wait.until(EC.presence_of_all_elements_located(self.hottest_offers_pages_locator))
         logging.debug(f'Found {len(pagination_buttons)} hottest offers pages')
-        all_hottest_offers = []
 
         for page_index in range(len(pagination_buttons)):
             # Refresh the list of pagination buttons
             pagination_buttons = wait.until(EC.presence_of_all_elements_located(self.hottest_offers_pages_locator))
             if page_index > 0:
                 pagination_buttons[page_index].click()
-                logging.debug(f'Clicked {page_index} page button')
-
-            items = wait.until(EC.presence_of_all_elements_located(self.hottest_offers_locator))
-            # Extract information from each item
-            for item in items:
-                link_element = item.find_element(By.TAG_NAME, "a")
-                href = link_element.get_attribute("href")
-                title = link_element.get_attribute("title")
-                image_element = item.find_element(By.TAG_NAME, "img")
-                image_src = image_element.get_attribute("src")
-
-                if (offer := PepperOffer(title, href, image_src)) not in self.cache:
-                    logging.info(f'Found new {offer=}')
-                    self.cache.add(offer)
-                    all_hottest_offers.append(offer)
-                # offer = PepperOffer(title, href, image_src)
-                # all_hottest_offers.append(offer)
-        driver.close()
-        return all_hottest_offers
+                logging.debug('Clicked %d page button', page_index)
+
+            # Script result doubles as wait condition, so cards are not fetched as element references first
+            yield wait.until(
+                lambda d: d.execute_script(HOTTEST_OFFERS_SCRIPT, f'.{self.hottest_offers_locator[1]}')
+            )
 
     def new_offers_to_dict(self, new_offers: list[PepperOffer]) -> list[dict[str, str]]:
         return [offer.__dict__ for offer in new_offers]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit_driver()
+        super().__exit__(exc_type, exc_val, exc_tb)
@@ -1,14 +1,28 @@
+import dataclasses
 import logging
+import os
 import pickle
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from pathlib import Path
 
-from zstandard import ZstdDecompressor, ZstdCompressor
+from zstandard import ZstdDecompressor, ZstdCompressor, ZstdError
 
 
 class ScrapperBase(ABC):
-    def __init__(self, cache_path: Path | None = None):
+    # Earliest inserted offers are dropped above this size, so cache file and save time stop growing over months
+    MAX_CACHE_SIZE = 50_000
+
+    def __init__(self, cache_path: Path | None = None, offer_type: type | None = None):
         super().__init__()
+        if cache_path and not dataclasses.is_dataclass(offer_type):
+            raise ValueError(f"Cached scrapper needs dataclass offer_type, got {offer_type!r}")
+        self.offer_type = offer_type
+        # Reused for every load/save instead of initializing zstd contexts each time
+        self.compressor = ZstdCompressor(level=3)
+        self.decompressor = ZstdDecompressor()
+        # Set when an offer was inserted (or evicted) since last load/save
+        self.cache_dirty = False
         if cache_path:
             self.cache_path = cache_path
             self.cache = self.load_cache()
@@ -27,20 +41,61 @@ class ScrapperBase(ABC):
     def load_cache(self):
         if self.cache_path.exists():
             logging.debug(f"Loading cached data: {self.cache_path.resolve()}")
-            with open(self.cache_path, 'rb') as f:
-                data = f.read()
-            data = ZstdDecompressor().decompress(data)
-            return pickle.loads(data)
+            try:
+                with open(self.cache_path, 'rb') as f, self.decompressor.stream_reader(f) as reader:
+                    cache = pickle.load(reader)
+                if isinstance(cache, set):
+                    # Old format with pickled offer objects
+                    return OrderedDict.fromkeys(cache)
+                if not (isinstance(cache, tuple) and len(cache) == 2):
+                    logging.warning(f"Unknown cache format, starting with empty one: {self.cache_path.resolve()}")
+                    return OrderedDict()
+                saved_names, rows = cache
+                # Fields are restored by name, so reordering offer fields does not mix up values
+                names = [field.name for field in dataclasses.fields(self.offer_type)]
+                if missing := set(names) - set(saved_names):
+                    logging.warning(f"Cache misses offer fields {missing}, starting with empty one: {self.cache_path.resolve()}")
+                    return OrderedDict()
+                indices = [saved_names.index(name) for name in names]
+                return OrderedDict.fromkeys(
+                    self.offer_type(**{name: row[i] for name, i in zip(names, indices)}) for row in rows
+                )
+            except (OSError, EOFError, ZstdError, pickle.UnpicklingError):
+                logging.exception(f"Failed to load cache, starting with empty one: {self.cache_path.resolve()}")
+                return OrderedDict()
         logging.debug(f"No cache found in: {self.cache_path.resolve()}")
-        return set()
+        return OrderedDict()
+
+    def is_new_offer(self, offer) -> bool:
+        # Cache keys are kept in insertion order, seen offer keeps its position
+        if offer in self.cache:
+            return False
+        self.cache_dirty = True
+        self.cache[offer] = None
+        while len(self.cache) > self.MAX_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return True
 
     def save_cache(self):
-        data = pickle.dumps(self.cache, protocol=pickle.HIGHEST_PROTOCOL)
-        data = ZstdCompressor().compress(data)
-        with open(self.cache_path, 'wb') as f:
-            f.write(data)
+        if not self.cache_dirty:
+            logging.debug(f"Cache not changed, skipping save: {self.cache_path.resolve()}")
+            return
+        # Offers are stored as plain tuples with field names saved once,
+        # pickling them is much cheaper than pickling dataclass instances
+        names = [field.name for field in dataclasses.fields(self.offer_type)]
+        rows = [tuple(getattr(offer, name) for name in names) for offer in self.cache]
+        # Write to temporary file and swap it in, so crash during save never leaves half written cache
+        tmp_path = self.cache_path.with_suffix(self.cache_path.suffix + '.tmp')
+        # Pickle straight into compressor, no intermediate copy of serialized cache
+        with open(tmp_path, 'wb') as f, self.compressor.stream_writer(f) as writer:
+            pickle.dump((names, rows), writer, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        self.cache_dirty = False
         logging.debug(f"Saving cache data: {self.cache_path.resolve()}")
 
-    def __del__(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
         if self.cache_path:
             self.save_cache()